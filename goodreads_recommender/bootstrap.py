@@ -1,6 +1,7 @@
 from typing import Optional, Set
 
 from goodreads_recommender.logger import Logger
+from goodreads_recommender.services.book_service import BookService
 from goodreads_recommender.services.config_service import ConfigService
 from goodreads_recommender.services.download_service import DownloadService
 from goodreads_recommender.services.list_service import ListService, BookFilter
@@ -8,12 +9,18 @@ from goodreads_recommender.services.recommendation_engine import RecommendationE
 from goodreads_recommender.services.report_service import ReportService
 
 
+def _days_to_seconds(days: Optional[float]) -> Optional[float]:
+    return None if days is None else days * 24 * 60 * 60
+
+
 def bootstrap_list_service(
     book_filter: BookFilter,
     output_file: Optional[str] = None,
     verbose: bool = False,
     parse_args: bool = False,
     report_shelves: Optional[Set[str]] = None,
+    threads: int = 20,
+    cache_max_age_days: Optional[float] = None,
 ) -> ListService:
     """
     book_filter: for example the `strict_filter`
@@ -24,23 +31,36 @@ def bootstrap_list_service(
     report_shelves: A set of shelves that you want to see in the generated output for
     each book. Helps to understand what kind of book that is. By default uses the
     genres of each book. For example { "slice-of-life", "friendship" }
+
+    threads: How many books to download and filter at once. Higher is faster, but
+    goodreads might not like it.
+
+    cache_max_age_days: Check cached pages for changes after that many days. By
+    default, cached pages are used forever.
     """
     config_service = ConfigService(
         output_file=output_file,
         verbose=verbose,
         parse_args=parse_args,
+        threads=threads,
     )
     logger = Logger(config_service)
-    download_service = DownloadService(logger)
+    download_service = DownloadService(
+        logger,
+        max_connections=config_service.threads,
+        max_age=_days_to_seconds(cache_max_age_days),
+    )
+    book_service = BookService(download_service, logger)
     report_service = ReportService(
         config_service,
-        download_service,
+        book_service,
         logger,
         report_shelves,
     )
     list_service = ListService(
         config_service,
         download_service,
+        book_service,
         report_service,
         logger,
         book_filter,
@@ -58,6 +78,8 @@ def recommend(
     parse_args: bool = False,
     report_shelves: Optional[Set[str]] = None,
     pickle_book_scores: bool = False,
+    cache_max_age_days: Optional[float] = None,
+    threads: int = 20,
 ):
     """
     user_id: Taken from the url when navigating to your profile. In this example,
@@ -81,22 +103,37 @@ def recommend(
 
     pickle_book_scores: If true, create a .pickle file and load it next time, to avoid
     parsing reviews from scratch each time. Helps to more quickly adjust the filter.
+
+    cache_max_age_days: Check cached pages for changes after that many days. By
+    default, cached pages are used forever.
+
+    threads: How many users to download reviews of at once. Higher is faster, but
+    goodreads might not like it.
     """
     config_service = ConfigService(
         output_file=output_file,
         verbose=verbose,
         parse_args=parse_args,
+        threads=threads,
     )
     logger = Logger(config_service)
-    download_service = DownloadService(logger, cookie)
+    download_service = DownloadService(
+        logger,
+        cookie,
+        max_connections=config_service.threads,
+        max_age=_days_to_seconds(cache_max_age_days),
+    )
+    book_service = BookService(download_service, logger)
     report_service = ReportService(
         config_service,
-        download_service,
+        book_service,
         logger,
         report_shelves,
     )
     recommendation_engine = RecommendationEngine(
+        config_service,
         download_service,
+        book_service,
         report_service,
         logger,
         number_of_recommendations,
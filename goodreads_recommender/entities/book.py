@@ -1,14 +1,258 @@
-import json
+import functools
 import re
-from typing import List, Tuple, Set, Optional
-
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Tuple,
+    Set,
+    Optional,
+    TypeVar,
+)
+
+import lxml.html
 from bs4 import BeautifulSoup
 
+try:
+    # Optional, parses the large __NEXT_DATA__ json a few times faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 from goodreads_recommender.logger import Logger
 from goodreads_recommender.services.download_service import DownloadService
 
 
+# Compiled once, since they are used for every book, shelf and series entry
+_SHELVES_HREF_RE = re.compile(r"/work/shelves/(\d+-[^\"/?#]+)")
+_WORK_SHELVES_RE = re.compile(r'https://www\.goodreads\.com/work/shelves/(\d+-.+?)"')
+_NEXT_DATA_RE = re.compile(
+    r'<script[^>]*\bid="__NEXT_DATA__"[^>]*>(.*?)</script>',
+    re.DOTALL,
+)
+_PEOPLE_RE = re.compile(r"(\d+) people")
+# Match "Book 1" "Book 2" "Book 1.5" but not all the other odd stuff.
+# Things like "Book 1-3" or "Book 4 Part 4 of 4" should be excluded
+_BOOK_NUMBER_RE = re.compile(r"^Book \d(\.\d)?$")
+
+# Genres and shelves that people only use if an audiobook exists
+_AUDIOBOOK_SHELVES = frozenset(
+    {"audiobook", "audiobooks", "audio-book", "audible", "audio"}
+)
+
+
+class BookPage(NamedTuple):
+    """Everything that Book needs from the book/show page. Cached as a pickle, so
+    that the html doesn't have to be parsed again."""
+
+    # for example 17650479.Becky_Chambers
+    author: Optional[str]
+    # for example 170872-wayfarers
+    series: Optional[str]
+    # for example science-fiction-fantasy
+    genres: List[str]
+    editions_id: Optional[str]
+    # (user_id, rating) of the reviews shown on the page
+    reviews: List[Tuple[int, int]]
+    shelves_id: Optional[str]
+    has_audiobook_shelf: bool
+    num_ratings: Optional[int]
+    year: Optional[int]
+    rating: Optional[float]
+
+
+# Increase this when changing BookPage or _parse_book_page
+BOOK_PAGE_VERSION = 2
+
+# Increase this when changing _parse_series_page
+SERIES_PAGE_VERSION = 1
+
+
+def _get_first_text(tree: lxml.html.HtmlElement, xpath: str) -> Optional[str]:
+    """The text at the beginning of the first element that matches the xpath."""
+    elements = tree.xpath(xpath)
+    if len(elements) == 0:
+        return None
+
+    element = elements[0]
+    if element.text is not None:
+        return element.text
+
+    if len(element) > 0:
+        return element[0].text_content()
+
+    return None
+
+
+def _get_shelves_id(tree: lxml.html.HtmlElement, html: str) -> Optional[str]:
+    """For example 1234-the-title, to find the shelves of the book. None if the page
+    or link is broken, idk."""
+    # I'll only look at the first page of shelves, as they quickly drop in
+    # relevance.
+    for href in tree.xpath('//a[contains(@href, "/work/shelves/")]/@href'):
+        regex_match = _SHELVES_HREF_RE.search(href)
+        if regex_match is not None:
+            return regex_match[1]
+
+    # The link might not be an anchor, scan the whole page as a last resort.
+    regex_match = _WORK_SHELVES_RE.search(html)
+    return regex_match[1] if regex_match is not None else None
+
+
+def _parse_apollo_state(apollo_state: Dict[str, Any]) -> Dict[str, Any]:
+    """Collect everything Book needs from the apollo state of the page in a single
+    pass, because it can contain thousands of entries."""
+    author = None
+    series = None
+    editions_id = None
+    book_genres = []
+    reviews = []
+
+    for key, value in apollo_state.items():
+        typename = value.get("__typename")
+
+        if key.startswith("Review:"):
+            reviews.append(
+                (int(value["creator"]["__ref"].split(":")[-1]), value["rating"])
+            )
+
+        if author is None and typename == "Contributor":
+            author = value["webUrl"].split("/")[-1]
+
+        if series is None and typename == "Series":
+            series = value["webUrl"].split("/")[-1]
+
+        if editions_id is None and "editions" in value:
+            editions_id = value["editions"]["webUrl"].split("/")[-1]
+
+        # they aren't complete in the html, have to check the json metadata
+        if "bookGenres" in value:
+            book_genres += value["bookGenres"]
+
+    # This is not a set, because genres are sorted by how often they have been
+    # shelved or something. A set would lose that information.
+    genres = [
+        genre["genre"]["webUrl"].replace("https://www.goodreads.com/genres/", "")
+        for genre in book_genres
+    ]
+
+    return {
+        "author": author,
+        "series": series,
+        "genres": genres,
+        "editions_id": editions_id,
+        "reviews": reviews,
+    }
+
+
+def _parse_book_page(html: str) -> BookPage:
+    # The json in __NEXT_DATA__ is most of the page. Cut it out with a regex, so
+    # that the html parser doesn't have to copy it into the tree as well.
+    next_data_match = _NEXT_DATA_RE.search(html)
+    if next_data_match is None:
+        raise ValueError("No __NEXT_DATA__ found")
+
+    stats_raw = next_data_match[1]
+
+    # This page is parsed for every single book, so skip BeautifulSoup and use lxml
+    # directly, which is a lot faster.
+    tree = lxml.html.fromstring(
+        html[: next_data_match.start(1)] + html[next_data_match.end(1) :]
+    )
+
+    shelves_id = _get_shelves_id(tree, html)
+
+    num_ratings = None
+    ratings_count = _get_first_text(tree, '//span[@data-testid="ratingsCount"]')
+    if ratings_count is not None:
+        # turn 12,345 to 12345
+        ratings_count = ratings_count.replace(",", "")
+        if ratings_count.isdigit():
+            num_ratings = int(ratings_count)
+
+    year = None
+    # <p data-testid="publicationInfo">First published June 1, 2002</p>
+    publication_info = _get_first_text(tree, '//p[@data-testid="publicationInfo"]')
+    if publication_info is not None:
+        year_text = publication_info.split()[-1]
+        if year_text.isdigit():
+            year = int(year_text)
+
+    rating: Optional[float] = 0.0
+    rating_text = _get_first_text(
+        tree,
+        '//*[contains(concat(" ", @class, " "), " RatingStatistics__rating ")]',
+    )
+    # If missing, the page is broken: "This item does not meet our catalog
+    # guidelines and can no longer be rated or reviewed."
+    if rating_text is not None:
+        try:
+            rating = float(rating_text)
+        except ValueError:
+            # Only fail if someone actually asks for the rating
+            rating = None
+
+    stats = json_loads(stats_raw)
+
+    return BookPage(
+        **_parse_apollo_state(stats["props"]["pageProps"]["apolloState"]),
+        shelves_id=shelves_id,
+        # A substring check on the raw html is cheap, and also finds the link if it
+        # is only part of the json data.
+        has_audiobook_shelf="shelf=audiobook" in html,
+        num_ratings=num_ratings,
+        year=year,
+        rating=rating,
+    )
+
+
+def _parse_series_page(html: str) -> Set[str]:
+    soup = BeautifulSoup(html, features="lxml")
+
+    edition_ids = set()
+
+    rows = soup.select(".listWithDividers__item")
+    for row in rows:
+        title = str(row.select("h3")[0].contents[0].text)
+        if _BOOK_NUMBER_RE.match(title):
+            edition_ids.add(row.select('a[href*="/book/show/"]')[0].attrs["href"])
+
+    return edition_ids
+
+
+T = TypeVar("T")
+
+
+def _cached(method: Callable[["Book"], T]) -> Callable[["Book"], T]:
+    """Remember the return value of a Book method, so that filters and reports can
+    call it as often as they like without parsing or downloading anything twice."""
+
+    @functools.wraps(method)
+    def wrapped(self: "Book") -> T:
+        try:
+            return self._cache[method.__name__]
+        except KeyError:
+            result = method(self)
+            self._cache[method.__name__] = result
+            return result
+
+    return wrapped
+
+
 class Book:
+    # Thousands of books can be alive while scanning lists. __weakref__ is needed
+    # for the BookService.
+    __slots__ = (
+        "_download_service",
+        "_logger",
+        "book_id",
+        "_cache",
+        "_page",
+        "__weakref__",
+    )
+
     def __init__(
         self,
         book_id: str,
@@ -18,54 +262,41 @@ class Book:
         self._download_service = download_service
         self._logger = logger
         self.book_id = book_id
+        self._cache: Dict[str, Any] = {}
+
+        self._page = self._get_book_page(book_id)
 
-        self._soup = self._get_book_soup(book_id)
-        self._stats = self._get_book_stats()
-        self._apollo_state = self._stats["props"]["pageProps"]["apolloState"]
+    def _is_cached(self, method: Callable[[], Any]) -> bool:
+        """If a method decorated with _cached already has its return value."""
+        return method.__name__ in self._cache
 
-    def _get_book_soup(self, book_id: str) -> BeautifulSoup:
-        return self._download_service.get(f"book/show/{book_id}")
+    def _get_book_page(self, book_id: str) -> BookPage:
+        return self._download_service.get_parsed(
+            f"book/show/{book_id}",
+            _parse_book_page,
+            BOOK_PAGE_VERSION,
+        )
 
     def _get_shelves_soup(self, name: str) -> BeautifulSoup:
         return self._download_service.get(f"work/shelves/{name}")
 
-    def _get_editions_soup(self, id: str) -> BeautifulSoup:
+    def _get_editions_html(self, id: str) -> str:
         # congratulations. filtering for audiobook does not include audible.
-        return self._download_service.get(f"work/editions/{id}?per_page=100")
-
-    def _get_book_stats(self):
-        stats_raw = str(self._soup.select("#__NEXT_DATA__")[0].contents[0])
-        stats = json.loads(stats_raw)
-        return stats
+        return self._download_service.get_text(f"work/editions/{id}?per_page=100")
 
     def get_user_ids_who_liked_book(self, minimum_score=4) -> List[int]:
         """Get the user_ids of those users that left a positive review."""
-        user_ids = []
-        for key, value in self._apollo_state.items():
-            if not key.startswith("Review:"):
-                continue
-
-            if value["rating"] < minimum_score:
-                continue
-
-            user_ids.append(int(value["creator"]["__ref"].split(":")[-1]))
-
-        return user_ids
+        return [
+            user_id for user_id, rating in self._page.reviews if rating >= minimum_score
+        ]
 
+    @_cached
     def get_top_shelves_and_their_count(self) -> List[Tuple[str, int]]:
-        # I'll only look at the first page of shelves, as they quickly drop in
-        # relevance.
-        raw = str(self._soup)
-        regex_match = re.search(
-            r'https://www\.goodreads\.com/work/shelves/(\d+-.+?)"',
-            raw,
-        )
+        shelves_id = self._page.shelves_id
 
-        if regex_match is None:
-            # page broken, link broken, idk
+        if shelves_id is None:
             return []
 
-        shelves_id = regex_match[1]
         shelves_soup = self._get_shelves_soup(shelves_id)
         shelf_stats = shelves_soup.select(".shelfStat")
 
@@ -74,52 +305,51 @@ class Book:
         for shelf_stat in shelf_stats:
             name = shelf_stat.select("a")[0].contents[0].getText()
             content = shelf_stat.select("div:nth-child(2)")[0].contents[0].getText()
-            match = re.search(r"(\d+) people", content)
+            match = _PEOPLE_RE.search(content)
             if match is not None:
                 name_and_numbers.append((name, int(match.groups()[0])))
 
         return name_and_numbers
 
-    def get_num_ratings(self):
-        text = (
-            self._soup.select('span[data-testid="ratingsCount"]')[0]
-            .contents[0]
-            .getText()
-        )
+    def get_num_ratings(self) -> int:
+        if self._page.num_ratings is None:
+            raise ValueError(f"No ratings count found for {self.book_id}")
 
-        # turn 12,345 to 12345
-        return int(text.replace(",", ""))
+        return self._page.num_ratings
 
+    @_cached
     def does_audiobook_exist(self) -> bool:
-        if "shelf=audiobook" in str(self._soup):
+        if self._page.has_audiobook_shelf:
             # This doesn't always work. But it can be used to avoid handling
             # the editions page for performance. And also, turns out the editions
             # aren't always complete, So this check is pretty important
             return True
 
-        genres = self.get_genres()
-        if "audible" in genres or "audiobook" in genres:
+        if not _AUDIOBOOK_SHELVES.isdisjoint(self.get_genres()):
             return True
 
+        # The weighted_filter and reports might have downloaded the shelves already.
+        # If so, they are free to check, unlike the large editions page.
+        if self._is_cached(self.get_top_shelves_and_their_count):
+            shelves = [shelf for shelf, _ in self.get_top_shelves_and_their_count()]
+            if not _AUDIOBOOK_SHELVES.isdisjoint(shelves):
+                return True
+
         # have to download and parse the editions then
 
-        # get the editions-id
-        apollo_state: dict = self._apollo_state
-        for state in apollo_state.values():
-            if "editions" in state:
-                editions_id = state["editions"]["webUrl"].split("/")[-1]
-                break
-        else:
+        editions_id = self._page.editions_id
+        if editions_id is None:
             # somehow the editions-id is missing...
             self._logger.log("Failed to find editions-id")
             return False
 
-        editions_soup = self._get_editions_soup(editions_id)
+        # Only a few substrings are searched, there is no need to build a soup for
+        # that.
+        stringified = self._get_editions_html(editions_id)
 
         # there are false-positives when just searching for "audible", hardcoded in
         # a html dropdown form or something.
         # Multiple valid strings indicate audiobooks.
-        stringified = str(editions_soup)
         return (
             "Audible Studios" in stringified
             # the comma is important! Otherwise false positives
@@ -132,86 +362,39 @@ class Book:
     def get_genres(self) -> List[str]:
         """Get a list of genres like science-fiction-fantasy, possibly containing
         duplicates."""
-        # they aren't complete in the html, have to check the json metadata
-        apollo_state: dict = self._apollo_state
-
-        key: dict
-        genres = []
-        for apollo_state_element in apollo_state.values():
-            if "bookGenres" in apollo_state_element:
-                genres += apollo_state_element["bookGenres"]
-
-        # For example science-fiction-fantasy
-        # This is not a set, because genres are sorted by how often they have been
-        # shelved or something. A set would lose that information.
-        return [
-            genre["genre"]["webUrl"].replace("https://www.goodreads.com/genres/", "")
-            for genre in genres
-        ]
+        return self._page.genres
 
     def get_author(self) -> Optional[str]:
-        stats = self._get_book_stats()
-
-        apollo_state: dict = stats["props"]["pageProps"]["apolloState"]
-
-        for apollo_state_element in apollo_state.values():
-            if apollo_state_element["__typename"] == "Contributor":
-                # for example 17650479.Becky_Chambers
-                return apollo_state_element["webUrl"].split("/")[-1]
-
-        return None
+        return self._page.author
 
     def get_year(self) -> int:
-        # <p data-testid="publicationInfo">First published June 1, 2002</p>
-        return int(
-            self._soup.select('p[data-testid="publicationInfo"]')[0]
-            .contents[0]
-            .getText()
-            .split()[-1]
-        )
+        if self._page.year is None:
+            raise ValueError(f"No publication year found for {self.book_id}")
 
-    def get_rating(self) -> float:
-        rating_div = self._soup.select(".RatingStatistics__rating")
-        if len(rating_div) == 0:
-            # page broken
-            # "This item does not meet our catalog guidelines and can no longer be rated or reviewed."
-            return 0.0
-
-        return float(
-            self._soup.select(".RatingStatistics__rating")[0].contents[0].getText()
-        )
+        return self._page.year
 
-    def get_series(self) -> Optional[str]:
-        stats = self._get_book_stats()
-
-        apollo_state: dict = stats["props"]["pageProps"]["apolloState"]
+    def get_rating(self) -> float:
+        if self._page.rating is None:
+            raise ValueError(f"No valid rating found for {self.book_id}")
 
-        for apollo_state_element in apollo_state.values():
-            if apollo_state_element["__typename"] == "Series":
-                # for example 170872-wayfarers
-                return apollo_state_element["webUrl"].split("/")[-1]
+        return self._page.rating
 
-        return None
+    def get_series(self) -> Optional[str]:
+        return self._page.series
 
+    @_cached
     def get_series_book_ids(self) -> Set[str]:
         series_id = self.get_series()
 
         if series_id is None:
             return set()
 
-        soup = self._download_service.get(f"series/{series_id}")
-
-        edition_ids = set()
-
-        rows = soup.select(".listWithDividers__item")
-        for row in rows:
-            title = str(row.select("h3")[0].contents[0].text)
-            if re.match(r"^Book \d(.\d)?$", title):
-                # Match "Book 1" "Book 2" "Book 1.5" but not all the other odd stuff.
-                # Things like "Book 1-3" or "Book 4 Part 4 of 4" should be excluded
-                edition_ids.add(row.select('a[href*="/book/show/"]')[0].attrs["href"])
-
-        return edition_ids
+        # All books of a series share this page, so parse it only once.
+        return self._download_service.get_parsed(
+            f"series/{series_id}",
+            _parse_series_page,
+            SERIES_PAGE_VERSION,
+        )
 
     def get_genres_and_shelves(self) -> List[str]:
         return [
@@ -17,18 +17,26 @@ def strict_filter(
         Remove all books, even those with matching important_genres, if one or more
         of those genres are present.
     """
+    important_genres_set = frozenset(important_genres)
+    avoid_genres_set = frozenset(avoid_genres)
 
     def wrapped(book: Book, logger: Logger):
-        genres = book.get_genres()
-        for important_genre in important_genres:
-            if important_genre not in genres:
-                logger.verbose(f'Removed: {book.book_id}: "{important_genre}" missing')
-                return False
-
-        for avoid_genre in avoid_genres:
-            if avoid_genre in genres:
-                logger.verbose(f'Removed: {book.book_id}: has "{avoid_genre}"')
-                return False
+        genres = frozenset(book.get_genres())
+
+        missing_genres = important_genres_set - genres
+        if missing_genres:
+            # Most books are removed here, don't format anything that isn't shown
+            if logger.is_verbose:
+                formatted = ", ".join(f'"{genre}"' for genre in sorted(missing_genres))
+                logger.verbose(f"Removed: {book.book_id}: {formatted} missing")
+            return False
+
+        bad_genres = avoid_genres_set & genres
+        if bad_genres:
+            if logger.is_verbose:
+                formatted = ", ".join(f'"{genre}"' for genre in sorted(bad_genres))
+                logger.verbose(f"Removed: {book.book_id}: has {formatted}")
+            return False
 
         if minimum_rating is not None and book.get_rating() < minimum_rating:
             logger.verbose(f"Removed: {book.book_id}: Rating too low")
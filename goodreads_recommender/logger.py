@@ -1,20 +1,34 @@
+import sys
+import threading
+
 from goodreads_recommender.services.config_service import ConfigService
 
 
 class Logger:
+    __slots__ = ("config_service", "is_verbose", "_lock")
+
     def __init__(self, config_service: ConfigService):
         self.config_service = config_service
+        # Checked for every verbose message, so only look it up once
+        self.is_verbose = config_service.verbose
+        # Books are analyzed in multiple threads. Write each message in one go, so
+        # that lines of different threads don't get mixed up.
+        self._lock = threading.Lock()
+
+    def _write(self, line: str):
+        with self._lock:
+            sys.stdout.write(line + "\n")
 
     def log(self, *message):
-        print(*message)
+        self._write(" ".join([str(message_) for message_ in message]))
 
     def verbose(self, *message):
-        if not self.config_service.verbose:
+        if not self.is_verbose:
             return
 
         serialized = [str(message_) for message_ in message]
-        print("\x1b[0;34m" + " ".join(serialized) + "\x1b[0m")
+        self._write("\x1b[0;34m" + " ".join(serialized) + "\x1b[0m")
 
     def important(self, *message):
         serialized = [str(message_) for message_ in message]
-        print("\x1b[0;35m" + " ".join(serialized) + "\x1b[0m")
+        self._write("\x1b[0;35m" + " ".join(serialized) + "\x1b[0m")
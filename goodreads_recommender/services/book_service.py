@@ -0,0 +1,33 @@
+from weakref import WeakValueDictionary
+
+from goodreads_recommender.entities.book import Book
+from goodreads_recommender.logger import Logger
+from goodreads_recommender.services.download_service import DownloadService
+
+
+class BookService:
+    """Hands out Book objects. As long as a Book is still in use somewhere, asking for
+    the same book_id again returns the very same object, including everything it
+    already parsed and downloaded."""
+
+    def __init__(
+        self,
+        download_service: DownloadService,
+        logger: Logger,
+    ):
+        self.download_service = download_service
+        self.logger = logger
+        self._books: WeakValueDictionary[str, Book] = WeakValueDictionary()
+
+    def get_book(self, book_id: str) -> Book:
+        book = self._books.get(book_id)
+
+        if book is None:
+            book = Book(
+                book_id,
+                self.download_service,
+                self.logger,
+            )
+            self._books[book_id] = book
+
+        return book
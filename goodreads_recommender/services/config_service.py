@@ -5,14 +5,18 @@ from typing import Optional
 
 
 class ConfigService:
+    __slots__ = ("output_file", "verbose", "threads")
+
     def __init__(
         self,
         output_file: Optional[str] = None,
         verbose: bool = False,
         parse_args: bool = False,
+        threads: int = 20,
     ):
         self.output_file = output_file
         self.verbose = verbose
+        self.threads = threads
 
         if parse_args:
             self.parse_args()
@@ -31,12 +35,22 @@ class ConfigService:
             "--verbose",
             action="store_true",
         )
+        parser.add_argument(
+            "-t",
+            "--threads",
+            type=int,
+            help=f"how many books to download at once. Default: {self.threads}",
+            default=None,
+        )
 
         args = parser.parse_args()
 
         self.output_file = args.output_file
         self.verbose = args.verbose
 
+        if args.threads is not None:
+            self.threads = args.threads
+
         if self.output_file is None:
             print("No path for clean and sorted output specified.")
         else:
@@ -1,62 +1,206 @@
+import json
 import os
-from typing import Optional
+import pickle
+import threading
+import time
+from typing import Callable, Optional, TypeVar
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from goodreads_recommender.logger import Logger
 
+T = TypeVar("T")
+
 
 class DownloadService:
-    def __init__(self, logger: Logger, cookie: Optional[str] = None):
+    __slots__ = ("logger", "cookie", "max_age", "_session")
+
+    def __init__(
+        self,
+        logger: Logger,
+        cookie: Optional[str] = None,
+        max_connections: int = 20,
+        max_age: Optional[float] = None,
+    ):
+        """
+        max_connections: How many connections to keep alive at once. Should match
+        the number of threads that download pages.
+
+        max_age: After how many seconds cached pages are checked for changes. By
+        default, they are used forever.
+        """
         self.logger = logger
         self.cookie = cookie
+        self.max_age = max_age
+        self._session = self._create_session(max_connections)
+
+    def _create_session(self, max_connections: int) -> requests.Session:
+        # Keep connections to goodreads alive, instead of doing a new TCP and TLS
+        # handshake for each page.
+        session = requests.Session()
+        session.headers[
+            "User-Agent"
+        ] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0"
+
+        if self.cookie is not None:
+            session.headers["Cookie"] = self.cookie
+
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Let raise_for_status raise the HTTPError after the last attempt
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=max_connections, max_retries=retry)
+        session.mount("https://", adapter)
+        return session
 
     def delete_from_cache(self, path: str) -> None:
-        os.remove(os.path.join("goodreads_cache", path))
+        download_path = os.path.join("goodreads_cache", path)
+        os.remove(download_path)
+        self._remove_derived_files(download_path)
         self.logger.verbose(f'Cleared cache "{path}"')
 
+    def _remove_derived_files(self, download_path: str) -> None:
+        for suffix in [".pickle", ".meta.json"]:
+            try:
+                os.remove(f"{download_path}{suffix}")
+            except FileNotFoundError:
+                pass
+
+    def _is_stale(self, download_path: str) -> bool:
+        if self.max_age is None:
+            return False
+
+        try:
+            return time.time() - os.path.getmtime(download_path) > self.max_age
+        except FileNotFoundError:
+            return False
+
+    def _write_to_cache(self, download_path: str, content: bytes) -> None:
+        # Pages may be downloaded by multiple threads at the same time. Write to a
+        # temporary file first, so that nobody ever reads a half-written page.
+        os.makedirs(os.path.dirname(download_path), exist_ok=True)
+        temporary_path = f"{download_path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(content)
+        os.replace(temporary_path, download_path)
+
+    def get_parsed(
+        self,
+        path: str,
+        parse: Callable[[str], T],
+        version: int,
+    ) -> T:
+        """Like `get_text`, but also cache the return value of `parse` next to the
+        html, so that the page doesn't have to be parsed again in the next run.
+
+        version: Increase it whenever `parse` returns something different, to
+        invalidate old cached results.
+        """
+        download_path = os.path.join("goodreads_cache", path)
+        pickle_path = f"{download_path}.pickle"
+
+        html = None
+        if self._is_stale(download_path):
+            # Removes the pickle if the page changed in the meantime
+            html = self.get_text(path)
+
+        try:
+            with open(pickle_path, "rb") as f:
+                cached_version, parsed = pickle.load(f)
+                if cached_version == version:
+                    return parsed
+        except FileNotFoundError:
+            pass
+        except Exception:
+            self.logger.verbose(f'Ignoring broken "{pickle_path}"')
+
+        parsed = parse(html if html is not None else self.get_text(path))
+        self._write_to_cache(
+            pickle_path,
+            pickle.dumps((version, parsed), protocol=pickle.HIGHEST_PROTOCOL),
+        )
+        return parsed
+
     def get(self, path: str) -> BeautifulSoup:
         """Make a get request to goodreads and cache the result."""
+        return BeautifulSoup(self.get_text(path), features="lxml")
+
+    def get_text(self, path: str) -> str:
+        """Like `get`, but return the raw html, for those who parse it themselves."""
         download_path = os.path.join("goodreads_cache", path)
 
+        cached = None
         try:
-            with open(download_path, "r") as f:
-                content = f.read()
+            # Read everything at once and decode it in one go, instead of going
+            # through the text-mode reader with its newline translation.
+            with open(download_path, "rb") as f:
                 # self.logger.log('read cached list:', name, page)
-                return BeautifulSoup(content, features="lxml")
+                cached = f.read().decode("utf-8", errors="replace")
         except FileNotFoundError:
             pass
 
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
-        }
+        if cached is not None and not self._is_stale(download_path):
+            return cached
 
-        if self.cookie is not None:
-            headers["Cookie"] = self.cookie
+        return self._download(path, download_path, cached)
 
-        self.logger.verbose(f'Downloading "{path}" to "{download_path}"')
+    def _download(self, path: str, download_path: str, cached: Optional[str]) -> str:
+        """Download the page. If an outdated version is cached, ask goodreads to only
+        send the page if it changed since then."""
+        meta_path = f"{download_path}.meta.json"
+        headers = {}
 
-        attempts = 0
-        while True:
-            attempts += 1
+        if cached is not None:
             try:
-                response = requests.get(
-                    os.path.join("https://www.goodreads.com/", path),
-                    headers=headers,
-                    timeout=10 * attempts,
-                )
-                response.raise_for_status()
-                break
-            except Exception as exception:
-                # retry downloading once if it fails
-                if attempts >= 3:
-                    raise exception
+                with open(meta_path, "r") as f:
+                    meta = json.load(f)
+                if meta.get("etag") is not None:
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified") is not None:
+                    headers["If-Modified-Since"] = meta["last_modified"]
+            except (FileNotFoundError, ValueError):
+                pass
+
+        self.logger.verbose(f'Downloading "{path}" to "{download_path}"')
+
+        try:
+            response = self._session.get(
+                os.path.join("https://www.goodreads.com/", path),
+                headers=headers,
+                timeout=20,
+            )
+
+            if cached is not None and response.status_code == 304:
+                # Not modified. Mark the cached page as fresh again.
+                os.utime(download_path)
+                return cached
+
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if cached is None:
+                raise
+
+            # Being offline shouldn't be worse than never revalidating. The mtime stays
+            # old, so it is checked again next time.
+            self.logger.verbose(f'Using outdated "{path}", revalidating failed: {e}')
+            return cached
 
         content = response.text
 
-        os.makedirs(os.path.dirname(download_path), exist_ok=True)
-        with open(download_path, "x") as f:
-            f.write(content)
+        self._write_to_cache(download_path, content.encode("utf-8"))
+        # The pickle belongs to the old page
+        self._remove_derived_files(download_path)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is not None or last_modified is not None:
+            meta = {"etag": etag, "last_modified": last_modified}
+            self._write_to_cache(meta_path, json.dumps(meta).encode("utf-8"))
 
-        return BeautifulSoup(content, features="lxml")
+        return content
@@ -1,18 +1,29 @@
 import os
+import re
 import traceback
-from typing import Optional, Set, Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Optional, Callable, Iterable
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 from requests import HTTPError
 
 from goodreads_recommender.entities.book import Book
 from goodreads_recommender.logger import Logger
+from goodreads_recommender.services.book_service import BookService
 from goodreads_recommender.services.config_service import ConfigService
 from goodreads_recommender.services.download_service import DownloadService
 from goodreads_recommender.services.report_service import ReportService, Report
 
 BookFilter = Callable[[Book, Logger], bool]
 
+# Lists show "4.21 avg rating — 12,345 ratings", shelves "avg rating 4.21 — ..."
+_LISTED_RATING_RE = re.compile(r"(\d\.\d+) avg rating|avg rating (\d\.\d+)")
+
+
+def _is_listed_book_container(tag: Tag) -> bool:
+    # Lists use table rows, shelves use .elementList divs
+    return tag.name == "tr" or "elementList" in (tag.get("class") or [])
+
 
 class ListService:
     """A service to filter many books at once."""
@@ -21,12 +32,14 @@ class ListService:
         self,
         config_service: ConfigService,
         download_service: DownloadService,
+        book_service: BookService,
         report_service: ReportService,
         logger: Logger,
         book_filter: BookFilter,
     ):
         self.config_service = config_service
         self.download_service = download_service
+        self.book_service = book_service
         self.report_service = report_service
         self.logger = logger
         self.book_filter = book_filter
@@ -37,37 +50,51 @@ class ListService:
         list_ids: Optional[Iterable[str]] = None,
         shelf_ids: Optional[Iterable[str]] = None,
         book_ids: Optional[Iterable[str]] = None,
+        minimum_rating: Optional[float] = None,
     ):
-        """Check a few books of those lists, and write the result to the output file."""
+        """Check a few books of those lists, and write the result to the output file.
+
+        minimum_rating: Skip books whose average rating, as shown on the list or
+        shelf, is lower than that, without even downloading them. This is much faster
+        than having the book_filter check the rating.
+        """
         reports = []
 
         self.logger.verbose(f"# {name}")
 
-        book_ids_from_all_sources: Set[str] = set()
-
-        if book_ids is not None:
-            book_ids_from_all_sources.update(book_ids)
+        # { book_id: average rating as shown on the list or shelf, if any }
+        book_ids_from_all_sources: Dict[str, Optional[float]] = {}
 
         for list_id in list_ids or []:
-            book_ids_from_all_sources = book_ids_from_all_sources.union(
-                self._get_book_ids_in_list(list_id)
-            )
+            book_ids_from_all_sources.update(self._get_book_ids_in_list(list_id))
 
         for shelf_id in shelf_ids or []:
-            book_ids_from_all_sources = book_ids_from_all_sources.union(
-                self._get_book_ids_in_shelf(shelf_id)
-            )
+            book_ids_from_all_sources.update(self._get_book_ids_in_shelf(shelf_id))
 
-        for book_id in book_ids_from_all_sources:
-            try:
-                report = self._analyze_book(book_id)
-                if report is not None:
-                    reports.append(report)
-            except HTTPError:
-                self.logger.log("Failed to download data for", book_id)
-            except Exception as e:
-                self.logger.log(book_id, "Failed due to a bug")
-                traceback.print_exc()
+        # Explicitly requested books are always analyzed, even if a list shows a low
+        # rating for them. So they go in last, without a rating.
+        if book_ids is not None:
+            book_ids_from_all_sources.update(dict.fromkeys(book_ids))
+
+        # Scanning is dominated by waiting for goodreads to respond, so analyze
+        # multiple books at once.
+        with ThreadPoolExecutor(max_workers=self.config_service.threads) as executor:
+            futures = {
+                executor.submit(self._analyze_book, book_id): book_id
+                for book_id, listed_rating in book_ids_from_all_sources.items()
+                if self._is_rating_sufficient(book_id, listed_rating, minimum_rating)
+            }
+            for future in as_completed(futures):
+                book_id = futures[future]
+                try:
+                    report = future.result()
+                    if report is not None:
+                        reports.append(report)
+                except HTTPError:
+                    self.logger.log("Failed to download data for", book_id)
+                except Exception as e:
+                    self.logger.log(book_id, "Failed due to a bug")
+                    traceback.print_exception(e)
 
         self.report_service.append_reports_to_file(name, reports)
 
@@ -79,33 +106,77 @@ class ListService:
     def _get_shelf_soup(self, name: str) -> BeautifulSoup:
         return self.download_service.get(f"shelf/show/{name}")
 
-    def _get_book_ids_in_list(self, name: str) -> set[str]:
-        # try to download the first n pages each. eventually, pages will be empty,
-        # but this script doesn't check for the highest page yet.
-        result = set()
-        for page in range(1, 5):
-            list_page = self._get_list_soup(name, page)
-            hrefs = [a.get("href") for a in list_page.select('a[href*="/book/show/"]')]
-            result.update(
-                set([os.path.basename(href) for href in hrefs if isinstance(href, str)])
+    def _is_rating_sufficient(
+        self,
+        book_id: str,
+        listed_rating: Optional[float],
+        minimum_rating: Optional[float],
+    ) -> bool:
+        if minimum_rating is None or listed_rating is None:
+            return True
+
+        if listed_rating < minimum_rating:
+            self.logger.verbose(f"Removed: {book_id}: Rating too low")
+            return False
+
+        return True
+
+    def _get_listed_books(self, soup: BeautifulSoup) -> Dict[str, Optional[float]]:
+        """Map the ids of the books on a list or shelf page to the average rating
+        that is shown next to them."""
+        result: Dict[str, Optional[float]] = {}
+        for a in soup.select('a[href*="/book/show/"]'):
+            href = a.get("href")
+            if not isinstance(href, str):
+                continue
+
+            book_id = os.path.basename(href)
+
+            listed_rating = None
+            # The nearest one, shelves might be inside a layout table
+            row = a.find_parent(_is_listed_book_container)
+            if row is not None:
+                matches = _LISTED_RATING_RE.findall(row.get_text())
+                # If there are multiple, it isn't clear which one belongs to the book
+                if len(matches) == 1:
+                    listed_rating = float(matches[0][0] or matches[0][1])
+
+            # Books are linked multiple times, e.g. the cover and the title
+            if result.get(book_id) is None:
+                result[book_id] = listed_rating
+
+        return result
+
+    def _get_book_ids_in_list(self, name: str) -> Dict[str, Optional[float]]:
+        # try to download the first n pages each. They are independent of each
+        # other, so download them at the same time.
+        pages = range(1, 5)
+        result: Dict[str, Optional[float]] = {}
+        with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+            list_soups = executor.map(
+                lambda page: self._get_list_soup(name, page),
+                pages,
             )
+            for list_soup in list_soups:
+                book_ids = self._get_listed_books(list_soup)
+
+                if len(book_ids) == 0:
+                    # The list is shorter than that, the following pages are empty
+                    # as well.
+                    break
+
+                result.update(book_ids)
 
         return result
 
-    def _get_book_ids_in_shelf(self, name: str) -> set[str]:
-        shelf_page = self._get_shelf_soup(name)
-        hrefs = [a.get("href") for a in shelf_page.select('a[href*="/book/show/"]')]
-        return set([os.path.basename(href) for href in hrefs if isinstance(href, str)])
+    def _get_book_ids_in_shelf(self, name: str) -> Dict[str, Optional[float]]:
+        return self._get_listed_books(self._get_shelf_soup(name))
 
     def _analyze_book(self, book_id) -> Optional[Report]:
         """Check if the book is interesting. If not, return None."""
         self.logger.verbose(f'Analyzing "{book_id}"')
 
-        book = Book(
-            book_id,
-            self.download_service,
-            self.logger,
-        )
+        book = self.book_service.get_book(book_id)
 
         if not self.book_filter(book, self.logger):
             return None
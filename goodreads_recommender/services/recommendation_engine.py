@@ -1,12 +1,18 @@
-import os
+import heapq
 import pickle
+import re
 import traceback
-from typing import Dict, List, Optional, Tuple, NamedTuple, Self
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, NamedTuple, Self
 
-from bs4 import Tag
+import lxml.html
+from lxml.etree import XPath
 
 from goodreads_recommender.entities.book import Book
 from goodreads_recommender.logger import Logger
+from goodreads_recommender.services.book_service import BookService
+from goodreads_recommender.services.config_service import ConfigService
 from goodreads_recommender.services.download_service import DownloadService
 from goodreads_recommender.services.list_service import BookFilter
 from goodreads_recommender.services.report_service import ReportService
@@ -31,33 +37,123 @@ class BookScores(dict):
         self,
         book_scores: Dict[str, BookScore],
     ) -> None:
-        for book_id in book_scores:
-            self[book_id] = book_scores[book_id].merge(
-                self.get(book_id) or BookScore(0, 0)
-            )
+        for book_id, book_score in book_scores.items():
+            existing = self.get(book_id)
 
-    def get_recommendations(self, minimum_rating: int = 4) -> Self:
-        # Return only popular books, and only if they have a positive average rating
-        # (rating as in "average rating of all the people that were reading the same
-        # books as me", not as in "average rating on goodreads across all users")
-        def key(item: Tuple[str, BookScore]):
-            return -item[1].number_of_reviews
+            if existing is None:
+                # Most books are only rated by a single user. A BookScore is an
+                # immutable NamedTuple, so it can be shared without creating a new one.
+                self[book_id] = book_score
+                continue
+
+            self[book_id] = BookScore(
+                total_score=existing.total_score + book_score.total_score,
+                number_of_reviews=existing.number_of_reviews
+                + book_score.number_of_reviews,
+            )
 
-        sorted_book_scores = sorted(
-            self.items(),
-            key=key,
+    def remove_book_ids(self, book_ids: Iterable[str]) -> None:
+        # Intersecting the keys only visits the few books that are in both
+        for book_id in self.keys() & book_ids:
+            del self[book_id]
+
+    def to_columns(self) -> Tuple[List[str], List[float], List[int]]:
+        """A compact representation for pickling. Three flat lists pickle a lot faster
+        than one BookScore object per book."""
+        return (
+            list(self.keys()),
+            [book_score.total_score for book_score in self.values()],
+            [book_score.number_of_reviews for book_score in self.values()],
         )
 
-        # dicts remember their order
-        return BookScores(
+    @classmethod
+    def from_columns(
+        cls,
+        columns: Tuple[List[str], List[float], List[int]],
+    ) -> "BookScores":
+        book_ids, total_scores, numbers_of_reviews = columns
+        return cls(
             {
-                book_id: book_score
-                for book_id, book_score in sorted_book_scores
-                if (book_score.total_score / book_score.number_of_reviews)
-                >= minimum_rating
+                book_id: BookScore(total_score, number_of_reviews)
+                for book_id, total_score, number_of_reviews in zip(
+                    book_ids,
+                    total_scores,
+                    numbers_of_reviews,
+                )
             }
         )
 
+    def iter_recommendations(
+        self,
+        minimum_rating: int = 4,
+    ) -> Iterator[Tuple[str, BookScore]]:
+        """Sorts lazily. Usually only a few dozen of many thousand books are looked
+        at, so the rest never has to be sorted."""
+        # Return only popular books, and only if they have a positive average rating
+        # (rating as in "average rating of all the people that were reading the same
+        # books as me", not as in "average rating on goodreads across all users")
+        # The index keeps the order of books with the same number of reviews, like
+        # sorted() would, and avoids comparing the book_ids.
+        heap = [
+            (-book_score.number_of_reviews, i, book_id, book_score)
+            for i, (book_id, book_score) in enumerate(self.items())
+            if book_score.total_score >= minimum_rating * book_score.number_of_reviews
+        ]
+        heapq.heapify(heap)
+
+        while len(heap) > 0:
+            _, _, book_id, book_score = heapq.heappop(heap)
+            yield book_id, book_score
+
+    def get_recommendations(self, minimum_rating: int = 4) -> Self:
+        # dicts remember their order
+        return BookScores(self.iter_recommendations(minimum_rating))
+
+
+def _has_class(name: str) -> str:
+    """XPath equivalent of the css selector `.name`"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+# Review pages are parsed for every single user, so use lxml directly instead of
+# BeautifulSoup, with XPaths that are compiled once.
+_private_profile_xpath = XPath('//*[@id="privateProfile"]')
+_description_xpath = XPath('//meta[@name="description"]/@content')
+_review_xpath = XPath(f'//*[{_has_class("bookalike")} and {_has_class("review")}]')
+# .rating > .value > span
+_rating_title_xpath = XPath(
+    f'.//*[{_has_class("rating")}]/*[{_has_class("value")}]/span/@title'
+)
+_book_href_xpath = XPath('.//a[contains(@href, "/book/show/")]/@href')
+# Matches <table id="books"> no matter the quotes and the order of attributes
+_reviews_table_start_re = re.compile(
+    r"""<table\b[^>]*?\sid\s*=\s*(["']?)books\1(?=[\s/>])""",
+    re.IGNORECASE,
+)
+_table_start_re = re.compile(r"<table\b", re.IGNORECASE)
+_table_end_re = re.compile(r"</table\s*>", re.IGNORECASE)
+
+
+def _find_reviews_table(html: str) -> Optional[Tuple[int, int]]:
+    """Only the table with the reviews is needed. Parsing just that is a lot faster
+    than parsing the whole page with its header, sidebar and footer. Returns the
+    start and end of the table in the html."""
+    start_match = _reviews_table_start_re.search(html)
+    if start_match is None:
+        return None
+
+    start = start_match.start()
+    end_match = _table_end_re.search(html, start)
+    if end_match is None:
+        return None
+
+    end = end_match.end()
+    if len(_table_start_re.findall(html, start, end)) > 1:
+        # A nested table, the cut would end too early
+        return None
+
+    return start, end
+
 
 rating_map = {
     "did not like it": 1,
@@ -67,6 +163,13 @@ rating_map = {
     "it was amazing": 5,
 }
 
+# There are only five possible scores of a single review, so create each BookScore
+# once and share it, like merge_book_scores does.
+_single_review_scores = {
+    rating: BookScore(total_score=rating, number_of_reviews=1)
+    for rating in rating_map.values()
+}
+
 
 class RecommendationEngine:
     # 1. iterate over all your books with a high rating
@@ -80,15 +183,23 @@ class RecommendationEngine:
 
     def __init__(
         self,
+        config_service: ConfigService,
         download_service: DownloadService,
+        book_service: BookService,
         report_service: ReportService,
         logger: Logger,
         number_of_recommendations: int,
     ):
+        self.config_service = config_service
         self.download_service = download_service
+        self.book_service = book_service
         self.report_service = report_service
         self.logger = logger
         self.number_of_recommendations = number_of_recommendations
+        # Popular readers review many of my books, and would otherwise be parsed again
+        # for each of them. Cleared once all reviews are collected.
+        # { (user_id, minimum_review_score, pages): BookScores }
+        self._users_book_scores_cache: Dict[Tuple[int, int, int], BookScores] = {}
 
     def _load_book_scores_pickle(self, user_id: int) -> BookScores:
         cached_book_scores_path = f"cached_book_scores_{user_id}.pickle"
@@ -97,7 +208,12 @@ class RecommendationEngine:
                 self.logger.log(
                     f'Loading review scores from "{cached_book_scores_path}"'
                 )
-                book_scores = pickle.load(file)
+                loaded = pickle.load(file)
+                # Older versions pickled the BookScores object itself
+                if isinstance(loaded, BookScores):
+                    book_scores = loaded
+                else:
+                    book_scores = BookScores.from_columns(loaded)
         except FileNotFoundError:
             book_scores = self._get_book_scores_of_users_who_read_the_same_books(
                 user_id
@@ -106,7 +222,11 @@ class RecommendationEngine:
             # quickly play around with different filters.
             self.logger.log(f'Caching review scores to "{cached_book_scores_path}"')
             with open(cached_book_scores_path, "wb") as file:
-                pickle.dump(book_scores, file)
+                pickle.dump(
+                    book_scores.to_columns(),
+                    file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
 
         return book_scores
 
@@ -123,42 +243,43 @@ class RecommendationEngine:
                 user_id
             )
 
-        recommendations = book_scores.get_recommendations()
+        raw_recommendations = islice(
+            book_scores.iter_recommendations(),
+            self.number_of_recommendations,
+        )
         self.report_service.append_books_to_file(
             name="Raw",
-            book_ids=list(recommendations.keys())[: self.number_of_recommendations],
+            books=[book_id for book_id, _ in raw_recommendations],
             sort=False,
         )
 
         if book_filter is not None:
             self.logger.verbose("Generating filtered recommendations...")
-            filtered_book_scores = self._filter_book_scores(
+            filtered_books = self._filter_books(
                 max_books=self.number_of_recommendations,
-                book_scores=recommendations,
+                # Filtering might need to look at more books than the raw ones
+                book_scores=book_scores.iter_recommendations(),
                 book_filter=book_filter,
             )
+            # Pass the Books themselves, so that the report can use everything that
+            # the filter already downloaded for them.
             self.report_service.append_books_to_file(
                 name="Filtered",
-                book_ids=filtered_book_scores.keys(),
+                books=filtered_books,
                 # Don't resort them, as they are already sorted by how much this script
                 # recommends them to the user.
                 sort=False,
             )
 
-    def _get_rating(self, review_soup: Tag) -> Optional[int]:
-        """review_soup: element with .bookalike.review classes."""
-        rating_value_soups = review_soup.select(".rating > .value > span")
-        if len(rating_value_soups) == 0:
-            # has not been rated
-            return None
-
+    def _get_rating(self, review: lxml.html.HtmlElement) -> Optional[int]:
+        """review: element with .bookalike.review classes."""
         # "title" refers to the human-readable rating
-        title = rating_value_soups[0].get("title")
-
-        if title is None:
+        titles = _rating_title_xpath(review)
+        if len(titles) == 0:
+            # has not been rated
             return None
 
-        return rating_map[str(title)]
+        return rating_map[str(titles[0])]
 
     def get_review_page_path(self, user_id, page_nr):
         return f"review/list/{user_id}?sort=rating&view=reviews&page={page_nr}"
@@ -170,65 +291,81 @@ class RecommendationEngine:
         num_review_pages_to_scrape: int = 2,
     ) -> BookScores:
         """Go into the users reviews page, and collect the various books that they rated."""
+        cache_key = (user_id, minimum_review_score, num_review_pages_to_scrape)
+        cached = self._users_book_scores_cache.get(cache_key)
+        if cached is not None:
+            # merge_book_scores never modifies the BookScores it merges, so sharing
+            # them is fine.
+            return cached
+
         book_scores = BookScores()
         for page_nr in range(1, num_review_pages_to_scrape + 1):
             path = self.get_review_page_path(user_id, page_nr)
-            reviews_soup = self.download_service.get(path)
-
-            if reviews_soup.select("#privateProfile"):
-                # Turns out the private profile error-page seems to also have the
-                # "Sign in" text on it. Beware, check for private profiles first.
-                # Return empty.
-                self.logger.verbose(
-                    f"Profile {user_id} is private, or your cookie is invalid"
+            html = self.download_service.get_text(path)
+            reviews_table = _find_reviews_table(html)
+
+            if reviews_table is not None:
+                start, end = reviews_table
+                reviews_tree = lxml.html.fromstring(html[start:end])
+                # A page with reviews on it is not a private profile, but the cookie
+                # might still be invalid. The meta description is in the header
+                # before the table.
+                header = html[:start]
+                descriptions = (
+                    _description_xpath(lxml.html.fromstring(header))
+                    if header.strip() != ""
+                    else []
                 )
-                return BookScores()
-
-            if "Sign in" in str(reviews_soup.select("meta[name=description]")):
+            else:
+                reviews_tree = lxml.html.fromstring(html)
+
+                if _private_profile_xpath(reviews_tree):
+                    # Turns out the private profile error-page seems to also have the
+                    # "Sign in" text on it. Beware, check for private profiles first.
+                    # Return empty.
+                    self.logger.verbose(
+                        f"Profile {user_id} is private, or your cookie is invalid"
+                    )
+                    book_scores = BookScores()
+                    self._users_book_scores_cache[cache_key] = book_scores
+                    return book_scores
+
+                descriptions = _description_xpath(reviews_tree)
+
+            if any("Sign in" in description for description in descriptions):
                 self.download_service.delete_from_cache(path)
                 raise Exception("Not logged in")
 
-            for review in reviews_soup.select(".bookalike.review"):
+            for review in _review_xpath(reviews_tree):
                 rating = self._get_rating(review)
 
                 if rating is None or rating < minimum_review_score:
                     continue
 
-                hrefs = [a.get("href") for a in review.select('a[href*="/book/show/"]')]
-                book_id = os.path.basename(str(hrefs[0]))
+                hrefs = _book_href_xpath(review)
+                # lxml attribute results are already strings
+                book_id = hrefs[0].rsplit("/", 1)[-1]
 
-                book_scores[book_id] = BookScore(
-                    total_score=rating,
-                    number_of_reviews=1,
-                )
+                book_scores[book_id] = _single_review_scores[rating]
 
+        self._users_book_scores_cache[cache_key] = book_scores
         return book_scores
 
     def _get_user_ids_who_liked_book(self, book_id: str) -> List[int]:
-        return Book(
-            book_id,
-            self.download_service,
-            self.logger,
-        ).get_user_ids_who_liked_book()
+        return self.book_service.get_book(book_id).get_user_ids_who_liked_book()
 
-    def _filter_book_scores(
+    def _filter_books(
         self,
         max_books: int,
-        book_scores: BookScores,
+        book_scores: Iterable[Tuple[str, BookScore]],
         book_filter: BookFilter,
-    ) -> BookScores:
-        filtered_book_scores = BookScores({})
+    ) -> List[Book]:
+        filtered_books: List[Book] = []
 
-        for book_id, score in book_scores.items():
+        for book_id, _ in book_scores:
             try:
-                keep = book_filter(
-                    Book(
-                        book_id,
-                        self.download_service,
-                        self.logger,
-                    ),
-                    self.logger,
-                )
+                book = self.book_service.get_book(book_id)
+                keep = book_filter(book, self.logger)
             except Exception as e:
                 traceback.print_exc()
                 print(f"Failed to filter {book_id}")
@@ -238,27 +375,39 @@ class RecommendationEngine:
                 continue
 
             self.logger.verbose(f"Added {book_id}")
-            filtered_book_scores[book_id] = score
+            filtered_books.append(book)
 
-            if len(filtered_book_scores) >= max_books:
+            if len(filtered_books) >= max_books:
                 break
 
-        return filtered_book_scores
+        return filtered_books
 
     def _get_book_scores_of_users(self, user_ids: List[int]) -> BookScores:
         accumulated_book_scores = BookScores()
-        for user_id in user_ids:
-            try:
-                their_book_scores = self._get_users_book_scores(user_id)
-                self.logger.verbose(
-                    f"  - {len(their_book_scores)} reviews of user {user_id}"
-                )
-
-                accumulated_book_scores.merge_book_scores(their_book_scores)
 
-            except Exception:
-                traceback.print_exc()
-                self.logger.verbose(f"Failed to collect reviews of user {user_id}")
+        # This is mostly waiting for goodreads to respond, so download the reviews
+        # of multiple users at once. Merging happens only in this thread.
+        with ThreadPoolExecutor(max_workers=self.config_service.threads) as executor:
+            futures = {
+                executor.submit(self._get_users_book_scores, user_id): user_id
+                for user_id in user_ids
+            }
+            for future in as_completed(futures):
+                user_id = futures[future]
+                try:
+                    their_book_scores = future.result()
+                    # This runs for every single user. Don't format the message if
+                    # it isn't shown anyway.
+                    if self.logger.is_verbose:
+                        self.logger.verbose(
+                            f"  - {len(their_book_scores)} reviews of user {user_id}"
+                        )
+
+                    accumulated_book_scores.merge_book_scores(their_book_scores)
+
+                except Exception as e:
+                    traceback.print_exception(e)
+                    self.logger.verbose(f"Failed to collect reviews of user {user_id}")
 
         return accumulated_book_scores
 
@@ -290,18 +439,23 @@ class RecommendationEngine:
 
         accumulated_book_scores = BookScores()
 
-        self.logger.verbose(f"{len(own_book_scores)} books")
+        liked_book_ids = [
+            book_id
+            for book_id, book_score in own_book_scores.items()
+            if book_score.total_score >= 3
+        ]
 
-        for i, our_book_id in enumerate(own_book_scores):
-            if own_book_scores[our_book_id].total_score < 3:
-                self.logger.verbose(f"Skipping {our_book_id}, didn't like")
-                continue
+        self.logger.verbose(
+            f"{len(own_book_scores)} books, "
+            f"skipping {len(own_book_scores) - len(liked_book_ids)} that I didn't like"
+        )
 
+        for i, our_book_id in enumerate(liked_book_ids):
             other_readers_user_ids = self._get_user_ids_who_liked_book(our_book_id)
 
             self.logger.verbose(
                 f"- {len(other_readers_user_ids)} users for book {our_book_id} "
-                f"{i}/{len(own_book_scores)}"
+                f"{i}/{len(liked_book_ids)}"
             )
 
             accumulated_book_scores.merge_book_scores(
@@ -309,8 +463,10 @@ class RecommendationEngine:
             )
 
         # Remove books that the user already read
-        for book_id in own_book_scores:
-            if book_id in accumulated_book_scores:
-                del accumulated_book_scores[book_id]
+        accumulated_book_scores.remove_book_ids(own_book_scores.keys())
+
+        # Only needed while collecting. Don't keep every reviewer in memory while
+        # filtering and writing the reports.
+        self._users_book_scores_cache.clear()
 
         return accumulated_book_scores
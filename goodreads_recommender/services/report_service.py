@@ -1,10 +1,12 @@
 import traceback
-from typing import List, Tuple, Set, NamedTuple, Optional, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from typing import List, Tuple, Set, NamedTuple, Optional, Iterable, Union
 
 from goodreads_recommender.entities.book import Book
 from goodreads_recommender.logger import Logger
+from goodreads_recommender.services.book_service import BookService
 from goodreads_recommender.services.config_service import ConfigService
-from goodreads_recommender.services.download_service import DownloadService
 
 
 class Report(NamedTuple):
@@ -17,6 +19,9 @@ class Report(NamedTuple):
     series_length: int
 
 
+_report_sort_key = attrgetter("author", "series", "book_id")
+
+
 class ReportService:
     """Write the report for recommendations to a file."""
 
@@ -25,7 +30,7 @@ class ReportService:
     def __init__(
         self,
         config_service: ConfigService,
-        download_service: DownloadService,
+        book_service: BookService,
         logger: Logger,
         report_shelves: Optional[Set[str]] = None,
     ):
@@ -35,7 +40,7 @@ class ReportService:
             kind of book is listed.
         """
         self.config_service = config_service
-        self.download_service = download_service
+        self.book_service = book_service
         self.report_shelves = report_shelves
         self.logger = logger
 
@@ -97,22 +102,22 @@ class ReportService:
     def append_books_to_file(
         self,
         name: str,
-        book_ids: Iterable[str],
+        books: Iterable[Union[str, Book]],
         sort=True,
     ):
-        reports = []
-        for book_id in book_ids:
-            book = Book(
-                book_id,
-                self.download_service,
-                self.logger,
-            )
-            try:
-                report = self.create_report(book)
-                reports.append(report)
-            except Exception as e:
-                traceback.print_exc()
-                self.logger.log(f"Failed to generate report for {book_id}")
+        """
+        books:
+            Either book_ids, or Book objects that are already loaded, for example
+            because they were just filtered.
+        """
+        # Creating reports requires downloading series and shelves, so do that for
+        # multiple books at once. map keeps the order of books.
+        with ThreadPoolExecutor(max_workers=self.config_service.threads) as executor:
+            reports = [
+                report
+                for report in executor.map(self._try_create_report, books)
+                if report is not None
+            ]
 
         self.append_reports_to_file(
             name,
@@ -120,6 +125,18 @@ class ReportService:
             sort,
         )
 
+    def _try_create_report(self, book: Union[str, Book]) -> Optional[Report]:
+        book_id = book if isinstance(book, str) else book.book_id
+        try:
+            if isinstance(book, str):
+                book = self.book_service.get_book(book)
+
+            return self.create_report(book)
+        except Exception:
+            traceback.print_exc()
+            self.logger.log(f"Failed to generate report for {book_id}")
+            return None
+
     def append_reports_to_file(
         self,
         section_header,
@@ -130,17 +147,18 @@ class ReportService:
         if self.config_service.output_file is None:
             return
 
-        with open(self.config_service.output_file, "a") as file:
-            file.write(f"# {section_header}\n")
-            # I think this should sort by the first element (author) first,
-            # then the second element (series)
-            sorted_reports = sorted(reports) if sort else reports
+        # Sort by author, then series. The book_id only breaks ties, so that the
+        # order is the same as when comparing the whole reports, without comparing
+        # the long shelf strings.
+        sorted_reports = sorted(reports, key=_report_sort_key) if sort else reports
 
-            for report in sorted_reports:
-                file.write(self.format_report(report))
-                file.write("\n")
+        # Build the whole section first, and write it in one go
+        lines = [f"# {section_header}"]
+        lines.extend(self.format_report(report) for report in sorted_reports)
+        section = "\n".join(lines) + "\n\n"
 
-            file.write("\n")
+        with open(self.config_service.output_file, "a") as file:
+            file.write(section)
 
     def format_report(self, report: Report):
         """Format the book-info from handle_book into a neat human-readable string."""
@@ -148,14 +166,14 @@ class ReportService:
             f"{report.series} ({report.series_length})" if report.series != "" else ""
         )
 
+        # Long authors or series push the following columns to the right instead of
+        # being cut off, so the columns are padded one after the other.
+        column_size = self.column_size
+        line = f"{report.author:<{column_size}}{series_formatted}"
+        line = f"{line:<{column_size * 2}}{report.book_id[: column_size - 1]}"
         return (
-            (
-                (report.author.ljust(self.column_size) + series_formatted).ljust(
-                    self.column_size * 2
-                )
-                + report.book_id[: self.column_size - 1]
-            ).ljust(self.column_size * 3)
-            + str(report.year).ljust(8)
-            + str(report.rating).ljust(8)
-            + report.formatted_report_shelves
+            f"{line:<{column_size * 3}}"
+            f"{report.year!s:<8}"
+            f"{report.rating!s:<8}"
+            f"{report.formatted_report_shelves}"
         )